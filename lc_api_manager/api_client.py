@@ -74,6 +74,25 @@ class APIClient:
         """
         return response
 
+    def is_cacheable_failure(self, exc: Exception) -> bool:  # pylint: disable=R0201
+        """
+        Args:
+            exc => exception raised by request or arequest
+        Returns:
+            Whether the failure should be cached, so that requests with the same request
+            hash raise a CachedFailureError instead of being re-submitted (see: APIManager
+            cache_on_failure). Default implementation doesn't cache OSError (including
+            ConnectionError and TimeoutError), on the assumption that it's transient.
+            Child classes should override this method if their HTTP library raises
+            errors for both transient and permanent failures (i.e., requests.HTTPError
+            for any 4XX or 5XX status code).
+        Preconditions:
+            N/A
+        Raises:
+            N/A
+        """
+        return not isinstance(exc, OSError)
+
     def request(self, *args, **kwargs) -> Any:
         """
         Args:
@@ -85,4 +104,17 @@ class APIClient:
         Raises:
             RateLimitReachedError: if API signals that rate limit has been reached
         """
-        raise NotImplementedError("request not implemented for type {}".format(type(self).__name__))
+        raise NotImplementedError(f"request not implemented for type {type(self).__name__}")
+
+    async def arequest(self, *args, **kwargs) -> Any:
+        """
+        Args:
+            Takes any positional or keyword arguments
+        Returns:
+            Response from API request. Async version of request, used by APIManager.arequest.
+        Preconditions:
+            N/A
+        Raises:
+            RateLimitReachedError: if API signals that rate limit has been reached
+        """
+        raise NotImplementedError(f"arequest not implemented for type {type(self).__name__}")
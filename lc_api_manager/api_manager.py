@@ -22,76 +22,204 @@
 ## SOFTWARE.
 
 
-from datetime import datetime
+import asyncio
 import os
+import random
 import time
-from typing import Any, Optional
+from typing import Any, Dict, List, Optional, Sequence, Tuple, Union
 
 from lc_cache import Cache
 
 from .api_client import APIClient, RateLimitReachedError
+from .request_batch import PendingRequest, RequestBatch
+from .request_hash import RequestHasher
+from .token_bucket import TokenBucket
 
 
 __author__ = "libcommon"
 
 
-class APIManager:
+# Operation class of requests when threshold is a single int
+DEFAULT_OP_CLASS = "default"
+
+# Sentinel returned by cache lookups when a request hash is not in the cache
+_MISS = object()
+
+
+class CachedFailureError(Exception):
+    """Signals that a previous API request with the same request hash
+    failed, and the failure was cached (see: cache_on_failure and
+    APIClient.is_cacheable_failure). The API request is not re-submitted.
+    Cached failures never expire, and must be removed from the cache to
+    retry the request.
+    """
+
+
+class _CachedFailure:
+    """Cache entry for a failed API request. Stores the name of the
+    exception type raised by the API client, and its message.
+    """
+    __slots__ = ("exc_type_name", "message")
+
+    def __init__(self, exc_type_name: str, message: str) -> None:
+        self.exc_type_name = exc_type_name
+        self.message = message
+
+
+class APIManager:    # pylint: disable=R0902
     """Manage requests to an API while transparently respecting rate limits
     and caching requests to reduce duplicative requests.
     """
     __slots__ = (
-        "cache",
-        "interval",
-        "interval_buffer",
-        "threshold",
+        "_buckets",
+        "_cache",
+        "_cache_check",
+        "_cache_get",
+        "_cache_get_or_miss",
+        "_cache_insert",
         "_cache_on_failure",
         "_client",
-        "_count",
-        "_start_time",
+        "_client_request",
+        "_gen_hash",
+        "_interval",
+        "_interval_buffer",
+        "_is_cacheable_failure",
+        "_process",
+        "_threshold",
+        "_thresholds",
         "_update_state_before_request",
     )
 
     def __init__(self,
                  interval: int,
-                 threshold: int,
+                 threshold: Union[int, Dict[str, int]],
                  client: APIClient,
                  cache: Cache,
                  interval_buffer: int = 3,
                  cache_on_failure: bool = True,
                  update_state_before_request: bool = False) -> None:
-        if interval <= 0:
-            raise ValueError("Interval must be greater than 0")
-        if threshold <= 0:
-            raise ValueError("Threshold must be greater than 0")
-        if interval_buffer < 0:
-            raise ValueError("Interval buffer must be greater than or equal to 0")
-
-        self.interval = interval + interval_buffer
-        self.threshold = threshold
+        # Threshold may be a single int for all requests, or a map of operation class
+        # (i.e., "read" and "write") to threshold, in which case each operation class
+        # has its own token bucket and requests of one class don't throttle another
+        # NOTE: Copy threshold map, so changes to the caller's map don't disagree
+        # with the thresholds in force.
+        thresholds = dict(threshold) if isinstance(threshold, dict) else {DEFAULT_OP_CLASS: threshold}
+        if interval <= 0 or interval_buffer < 0 or not thresholds or min(thresholds.values()) <= 0:
+            raise ValueError(self._gen_invalid_params_message(interval, thresholds))
+
+        self._interval = interval + interval_buffer
+        self._interval_buffer = interval_buffer
+        self._threshold = thresholds if isinstance(threshold, dict) else threshold
+        self._thresholds = thresholds
         self._client = client
-        self.cache = cache
+        self._cache = cache
+        # Bind client and cache methods once to avoid attribute lookups on every request
+        self._gen_hash = RequestHasher(client.gen_request_hash)
+        self._client_request = client.request
+        self._process = client.process_response_for_cache
+        self._is_cacheable_failure = client.is_cacheable_failure
+        self._cache_check = cache.check
+        self._cache_get = cache.get
+        self._cache_get_or_miss = getattr(cache, "get_or_miss", None)
+        self._cache_insert = cache.insert
         self._cache_on_failure = cache_on_failure
         self._update_state_before_request = update_state_before_request
-        self._count = 0
-        self._start_time: Optional[float] = None
+        self._buckets = self.gen_initial_state()
         self.update_state()
 
+    # NOTE: The following attributes are read-only after __init__, because client and
+    # cache methods are bound in __init__ and token rates are derived from them.
+
+    @property
+    def cache(self) -> Cache:
+        """Cache of API responses."""
+        return self._cache
+
+    @property
+    def interval(self) -> int:
+        """Length of rate limit interval in seconds, including interval buffer."""
+        return self._interval
+
+    @property
+    def interval_buffer(self) -> int:
+        """Buffer in seconds added to rate limit interval."""
+        return self._interval_buffer
+
+    @property
+    def threshold(self) -> Union[int, Dict[str, int]]:
+        """Number of requests allowed per interval, or copy of map of operation class to threshold."""
+        if isinstance(self._threshold, dict):
+            return dict(self._threshold)
+        return self._threshold
+
+    @staticmethod
+    def _gen_invalid_params_message(interval: int, thresholds: Dict[str, int]) -> str:
+        """
+        Args:
+            interval        => length of rate limit interval
+            thresholds      => map of operation class to threshold
+        Returns:
+            Error message describing the first invalid constructor parameter.
+        Preconditions:
+            At least one parameter is invalid
+        Raises:
+            N/A
+        """
+        if interval <= 0:
+            return "Interval must be greater than 0"
+        if not thresholds or min(thresholds.values()) <= 0:
+            return "Threshold must be greater than 0"
+        return "Interval buffer must be greater than or equal to 0"
+
+    def _validate_op_class(self, op_class: str) -> None:
+        """
+        Args:
+            op_class    => operation class of token bucket
+        Returns:
+            N/A
+        Preconditions:
+            N/A
+        Raises:
+            ValueError: if operation class has no token bucket
+        """
+        if op_class not in self._thresholds:
+            valid_op_classes = ", ".join(sorted(self._thresholds))
+            raise ValueError(f"Unknown operation class {op_class!r} (valid classes: {valid_op_classes})")
+
+    def gen_initial_state(self) -> Dict[str, TokenBucket]:
+        """
+        Args:
+            N/A
+        Returns:
+            Map of operation class to its token bucket. Each bucket starts full, and its
+            last refill time is the current value of the monotonic clock (see: TokenBucket).
+        Preconditions:
+            N/A
+        Raises:
+            N/A
+        """
+        return {op_class: TokenBucket(threshold, self._interval) for op_class, threshold in self._thresholds.items()}
+
     def update_state(self) -> None:     # pylint: disable=R0201
         """
         Args:
             N/A
         Procedure:
-            Update rate limit count and start time. Default implementation
+            Update number of tokens and last refill time. Default implementation
             is a NOOP. In situations where multiple programs, or multiple runs
             of the same program, are using the same API, child classes may override
-            this function to set the actual count and start time. For example, suppose an
+            this function to set the actual number of tokens. For example, suppose an
             API has a rate limit of 5,000 requests/hour, and provides an endpoint "/api/v1/rate_limit"
-            that returns the number of requests made toward the rate limit. A child class
+            that returns the number of requests remaining toward the rate limit. A child class
             could make a request to that API when the APIManager is instantiated to properly
-            set count and start time, otherwise the API manager would be ineffective.
+            set the number of tokens, otherwise the API manager would be ineffective.
+            Buckets are stored in `_buckets` as a map of operation class to TokenBucket
+            (see: lc_api_manager.token_bucket). Set the number of tokens with
+            TokenBucket.set_state, which is safe to call while other threads use the bucket.
             NOTE:
-                When setting start time from an API response, ensure the timezone is UTC to
-                avoid any incongruence with reset_state.
+                Last refill time is measured with the monotonic clock (see: time.monotonic),
+                whose origin is undefined. When setting it from an API response, convert the
+                response timestamp relative to the current time.monotonic() value.
         """
         return None
 
@@ -100,165 +228,411 @@ class APIManager:
         Args:
             N/A
         Procedure:
-            Reset count and start time.  Used to reset state once the rate limit interval has been reached.
+            Refill all token buckets to capacity and reset last refill times.
             Even though this method is public, you should not use it unless you know what you're doing.
         Preconditions:
             N/A
         """
-        self._count = 0
-        self._start_time = datetime.utcnow().timestamp()
+        for bucket in self._buckets.values():
+            bucket.reset()
 
-    def gen_remaining_time(self) -> float:
+    def gen_remaining_time(self, op_class: str = DEFAULT_OP_CLASS) -> float:
         """
         Args:
+            op_class    => operation class of token bucket
+        Returns:
+            Amount of time in seconds until the next token is available in the bucket,
+            or 0 if a token is available now.
+        Preconditions:
             N/A
+        Raises:
+            ValueError: if operation class has no token bucket
+        """
+        self._validate_op_class(op_class)
+        return self._buckets[op_class].gen_remaining_time()
+
+    def gen_remaining_requests(self, op_class: str = DEFAULT_OP_CLASS) -> int:
+        """
+        Args:
+            op_class    => operation class of token bucket
         Returns:
-            Amount of time in seconds remaining in the current interval.  If amount of time
-            passed is greater than the interval (plus the interval buffer), resets count
-            and start time.
+            Number of requests that can be made without waiting (number of whole tokens
+            in the bucket after refilling).
         Preconditions:
             N/A
         Raises:
-            ValueError: if start time is ahead of current timestamp
+            ValueError: if operation class has no token bucket
         """
-        # If timer hasn't been set, return interval
-        if self._start_time is None:
-            return self.interval
-        # Get current timestamp
-        current_ts = datetime.utcnow().timestamp()
-        # Start time can't be after current timestamp
-        if self._start_time > current_ts:
-            raise ValueError("Start time is ahead of current timestamp ({} > {})".format(self._start_time, current_ts))
-        # Time remaining is length of the interval minus time passed in current interval
-        return float(self.interval) - (current_ts - self._start_time)
+        self._validate_op_class(op_class)
+        return self._buckets[op_class].gen_remaining_requests()
 
-    def gen_remaining_requests(self) -> int:
+    def _gen_defer_time(self, remaining_time: float, retry_attempt: int = 0) -> float:
         """
         Args:
+            remaining_time  => time until required tokens are available (see: TokenBucket.gen_deficit_time)
+            retry_attempt   => number of times the API signalled the rate limit was reached
+        Returns:
+            Amount of time in seconds to sleep before retrying a request. Sleep time is
+            proportional to the token deficit, not to the length of the interval. If the
+            API signalled the rate limit was reached, adds exponential backoff with full
+            jitter (capped at the length of the interval), so that multiple processes
+            sharing a rate limit don't retry in lockstep.
+        Preconditions:
             N/A
+        Raises:
+            N/A
+        """
+        if retry_attempt > 0:
+            remaining_time += random.uniform(0, min(self._interval, 2 ** (retry_attempt - 1)))
+        return remaining_time
+
+    def _get_cached(self, request_hash: Any) -> Any:
+        """
+        Args:
+            request_hash    => hash of request parameters
+        Returns:
+            Cached response for request hash, or _MISS if request hash not in cache.
+            If the cache implements `get_or_miss(key, default)`, uses a single lookup.
+            Otherwise, falls back to `check` and `get`.
+        Preconditions:
+            N/A
+        Raises:
+            CachedFailureError: if a previous request with the same request hash failed
+        """
+        if self._cache_get_or_miss is not None:
+            cached = self._cache_get_or_miss(request_hash, _MISS)
+        # NOTE: Must use `check` here instead of `get` -> check for None value, because
+        # in certain cases None may be a valid cached value for a request hash.
+        elif self._cache_check(request_hash):
+            cached = self._cache_get(request_hash)
+        else:
+            return _MISS
+        if isinstance(cached, _CachedFailure):
+            raise CachedFailureError(f"Previous request failed with {cached.exc_type_name}: {cached.message}")
+        return cached
+
+    def _prepare_batch(self, calls: Sequence[Tuple[tuple, dict]]) -> RequestBatch:
+        """
+        Args:
+            calls       => positional and keyword arguments of each request
         Returns:
-            Number of remaining requests.  If start time hasn't been set, returns threshold.
-            If the amount of time passed is greater than the interval (plus the interval buffer),
-            resets count and start time.
+            Batch with cached responses set, and requests not in the cache queued to
+            submit. If request hash generation fails, or a previous request with the
+            same request hash failed, records the exception to raise once the rest of
+            the batch has been submitted (see: RequestBatch.gen_results).
         Preconditions:
             N/A
         Raises:
             N/A
         """
-        # If the time remaining is greater than the interval
-        # (AKA passed into new interval), reset state
-        if self.gen_remaining_time() > self.interval:
-            self.reset_state()
-        return self.threshold - self._count
+        batch = RequestBatch(len(calls))
+        for index, (args, kwargs) in enumerate(calls):
+            try:
+                request_hash = self._gen_hash(*args, **kwargs)
+                cached = _MISS if request_hash in batch else self._get_cached(request_hash)
+            except Exception as exc:    # pylint: disable=W0703
+                batch.add_error(exc)
+                continue
+            if cached is _MISS:
+                batch.add_request(index, request_hash, args, kwargs)
+            else:
+                batch.add_response(index, cached)
+        return batch
 
-    def _defer_until_next_interval(self) -> None:
+    def _acquire_tokens(self, op_class: str, count: int) -> int:
         """
         Args:
+            op_class    => operation class of token bucket
+            count       => maximum number of tokens to consume
+        Returns:
+            Update state if required, then consume up to count tokens and return the
+            number of tokens consumed (see: TokenBucket.consume).
+        Preconditions:
             N/A
-        Procedure:
-            Calculate remaining time in interval and sleep.
+        Raises:
+            KeyError: if operation class has no token bucket
+        """
+        if self._update_state_before_request:
+            self.update_state()
+        # NOTE: Consume tokens on successful and failed API requests, because
+        # some APIs may count unsuccessful requests toward rate limit.
+        return self._buckets[op_class].consume(count)
+
+    def _reserve_token(self, op_class: str, retry_attempt: int) -> float:
+        """
+        Args:
+            op_class        => operation class of token bucket
+            retry_attempt   => number of times the API signalled the rate limit was reached
+        Returns:
+            Update state if required, then reserve a token and return the amount of time
+            in seconds to sleep before making the request (see: TokenBucket.reserve).
+        Preconditions:
+            N/A
+        Raises:
+            KeyError: if operation class has no token bucket
+        """
+        if self._update_state_before_request:
+            self.update_state()
+        return self._gen_defer_time(self._buckets[op_class].reserve(), retry_attempt)
+
+    def _handle_request_error(self, request_hash: Any, op_class: str, exc: Exception) -> Tuple[None, bool]:
+        """
+        Args:
+            request_hash    => hash of request parameters
+            op_class        => operation class of token bucket
+            exc             => exception raised by API client
+        Returns:
+            If API signals that rate limit has been reached, drains the bucket and
+            returns (None, True).
+        Preconditions:
+            N/A
+        Raises:
+            Exception: exc, if it's for any reason other than rate limit reached
+        """
+        if isinstance(exc, RateLimitReachedError):
+            # Drain the bucket to reflect that rate limit was reached
+            self._buckets[op_class].drain()
+            return None, True
+        # If caching failed requests, insert failure into cache so the request isn't
+        # re-submitted. The API client decides which failures are transient and
+        # shouldn't be cached, so the request can be retried.
+        if self._cache_on_failure and self._is_cacheable_failure(exc):
+            self._cache_insert(request_hash, _CachedFailure(type(exc).__name__, str(exc)))
+        raise exc
+
+    def _handle_response(self, request_hash: Any, response: Any) -> Tuple[Any, bool]:
+        """
+        Args:
+            request_hash    => hash of request parameters
+            response        => API response
+        Returns:
+            Process response and insert into cache, then return (response, False).
         Preconditions:
             N/A
         Raises:
             N/A
         """
-        # Generate time remaining in interval
-        # NOTE: It's possble that the rate limit was reached before this block,
-        # but entered a new interval within this block. In this case,
-        # the API manager will simply sleep for the remainder of the interval.
-        # This implementation may change in the future to handle this (edge) case
-        # depending on how often it occurs.
-        remaining_time = self.gen_remaining_time()
-        # Sleep for remainder of interval
-        time.sleep(remaining_time)
-        # Reset state
-        self.reset_state()
+        self._cache_insert(request_hash, self._process(response))
+        return response, False
 
-    def _make_request(self, request_hash: Any, *args, **kwargs) -> Optional[Any]:
+    def _make_request(self, request_hash: Any, op_class: str, *args, **kwargs) -> Tuple[Optional[Any], bool]:
         """
         Args:
             request_hash    => hash of request parameters
+            op_class        => operation class of token bucket
         Returns:
-            Attempt API request and, if successful, add response to cache and return it.
-            If rate limit is reached, returns None.
+            Attempt API request and, if successful, add response to cache and return
+            (response, False). If API signals that rate limit has been reached,
+            returns (None, True).
         Preconditions:
             N/A
         Raises:
-            RateLimitReachedError: if API rate limit reached
-            Exception: if API request fails
+            Exception: if API request fails for any reason other than rate limit reached
         """
         try:
-            # Submit request to API and get response
-            response = self._client.request(*args, **kwargs)
-            # Process response and insert into cache
-            self.cache.insert(request_hash, self._client.process_response_for_cache(response))
-            return response
-        except Exception as exc:
-            # If error didn't arise due to rate limit being reached
-            if not isinstance(exc, RateLimitReachedError):
-                # If caching failed requests, process and insert into cache
-                if self._cache_on_failure:
-                    self.cache.insert(self._client.process_response_for_cache(None))
-            # Otherwise, set state to reflect that rate limit was reached
-            else:
-                self._count = self.threshold
-            raise
-        finally:
-            # NOTE: Increment count on successful and failed API requests, because
-            # some APIs may count unsuccessful requests toward rate limit.
-            self._count += 1
+            response = self._client_request(*args, **kwargs)
+        except Exception as exc:    # pylint: disable=W0703
+            return self._handle_request_error(request_hash, op_class, exc)
+        return self._handle_response(request_hash, response)
+
+    async def _amake_request(self, request_hash: Any, op_class: str, *args, **kwargs) -> Tuple[Optional[Any], bool]:
+        """
+        Args:
+            request_hash    => hash of request parameters
+            op_class        => operation class of token bucket
+        Returns:
+            Async version of _make_request using the API client's arequest method.
+        Preconditions:
+            N/A
+        Raises:
+            Exception: if API request fails for any reason other than rate limit reached
+        """
+        try:
+            response = await self._client.arequest(*args, **kwargs)
+        except Exception as exc:    # pylint: disable=W0703
+            return self._handle_request_error(request_hash, op_class, exc)
+        return self._handle_response(request_hash, response)
 
-    def request(self, *args, request_hash: Any = None, **kwargs) -> Any:
+    def _lookup_request(self, request_hash: Any, args: tuple, kwargs: dict) -> Tuple[Any, Any]:
+        """
+        Args:
+            request_hash    => hash of request parameters, or None to generate it
+            args            => positional arguments of request
+            kwargs          => keyword arguments of request
+        Returns:
+            Request hash and cached response for request hash, or _MISS if request
+            hash not in cache.
+        Preconditions:
+            N/A
+        Raises:
+            CachedFailureError: if a previous request with the same request hash failed
+            Exception: if request hash generation fails
+        """
+        if request_hash is None:
+            request_hash = self._gen_hash(*args, **kwargs)
+        return request_hash, self._get_cached(request_hash)
+
+    def request(self, *args, request_hash: Any = None, op_class: str = DEFAULT_OP_CLASS, **kwargs) -> Any:
         """
         Args:
             Takes any positional or keyword arguments
+            request_hash    => hash of request parameters (default: generated by API client)
+            op_class        => operation class of token bucket (see: APIManager.__init__)
         Returns:
             If the result of this request has already been cached, return cached response.
             Otherwise, submit API request pursuant to rate limit, and cache response.
-            If rate limit reached, will sleep for remainder of interval then
-            retry the API request.
+            If no tokens are available, will reserve the next token and sleep once until
+            it is available, then submit the API request.
         Preconditions:
             N/A
         Raises:
+            CachedFailureError: if a previous request with the same request hash failed
+            ValueError: if operation class has no token bucket
+            Exception: if request hash generation or API request fails
+        """
+        self._validate_op_class(op_class)
+        request_hash, cached = self._lookup_request(request_hash, args, kwargs)
+        if cached is not _MISS:
+            return cached
+        # NOTE: Retry in a loop rather than recursively, so that sustained throttling
+        # doesn't grow the stack or repeat the cache lookup above.
+        retry_attempt = 0
+        while True:
+            # If bucket is empty or API client signalled the rate limit was reached,
+            # sleep until the reserved token is available then submit API request
+            defer_time = self._reserve_token(op_class, retry_attempt)
+            if defer_time > 0:
+                time.sleep(defer_time)
+            response, rate_limit_reached = self._make_request(request_hash, op_class, *args, **kwargs)
+            if not rate_limit_reached:
+                return response
+            retry_attempt += 1
+
+    async def arequest(self, *args, request_hash: Any = None, op_class: str = DEFAULT_OP_CLASS, **kwargs) -> Any:
+        """
+        Args:
+            Takes any positional or keyword arguments
+        Returns:
+            Async version of request using the API client's arequest method. While waiting
+            for the next token, yields to the event loop instead of blocking the thread,
+            so many requests can be dispatched concurrently (i.e., with asyncio.gather).
+            NOTE: update_state is still called synchronously if update_state_before_request
+            is set, and blocks the event loop while it runs.
+        Preconditions:
+            N/A
+        Raises:
+            CachedFailureError: if a previous request with the same request hash failed
+            ValueError: if operation class has no token bucket
+            Exception: if request hash generation or API request fails
+        """
+        self._validate_op_class(op_class)
+        request_hash, cached = self._lookup_request(request_hash, args, kwargs)
+        if cached is not _MISS:
+            return cached
+        # NOTE: Token buckets are guarded by a threading.Lock, and nothing is awaited
+        # while it's held, so no asyncio lock is required between tasks.
+        retry_attempt = 0
+        while True:
+            defer_time = self._reserve_token(op_class, retry_attempt)
+            if defer_time > 0:
+                await asyncio.sleep(defer_time)
+            response, rate_limit_reached = await self._amake_request(request_hash, op_class, *args, **kwargs)
+            if not rate_limit_reached:
+                return response
+            retry_attempt += 1
+
+    def _take_requests(self, batch: RequestBatch, op_class: str) -> Tuple[float, List[PendingRequest]]:
+        """
+        Args:
+            batch       => batch of requests (see: _prepare_batch)
+            op_class    => operation class of token bucket
+        Returns:
+            Consume as many tokens as are available for the batch, and return
+            (0, requests to submit). If the bucket ran out, returns (time to sleep
+            until enough tokens are available for the rest of the batch, []).
+        Preconditions:
+            Batch has requests to submit
+        Raises:
+            N/A
+        """
+        consumed = self._acquire_tokens(op_class, len(batch))
+        if not consumed:
+            deficit_time = self._buckets[op_class].gen_deficit_time(len(batch))
+            return self._gen_defer_time(deficit_time, batch.retry_attempt), []
+        return 0.0, batch.take(consumed)
 
+    def request_many(self, calls: Sequence[Tuple[tuple, dict]], op_class: str = DEFAULT_OP_CLASS) -> List[Any]:
         """
-        # Generate request hash if not provided
-        if request_hash is None:
-            try:
-                request_hash = self._client.gen_request_hash(*args, **kwargs)
-            except Exception as exc:
-                err_type = type(exc)
-                raise err_type("Failed to generate request hash: {}".format(exc))
-        # If request hash in cache, return cached response
-        # NOTE: Must use `check` here instead of `get` -> check for None value, because
-        # in certain cases None may be a valid cached value for a request hash.
-        if self.cache.check(request_hash):
-            return self.cache.get(request_hash)
-        # Update state if required
-        if self._update_state_before_request:
-            self.update_state()
-        # Generate remaining requests in interval
-        remaining_requests = self.gen_remaining_requests()
-        # If requests remaining in interval
-        if remaining_requests > 0:
-            # Attempt API request
-            try:
-                response = self._make_request(request_hash, *args, **kwargs)
-            except RateLimitReachedError:
-                remaining_requests = 0
-        # If ran out of API requests or API client signalled the rate limit was reached
-        if remaining_requests == 0:
-            # Sleep until the next interval
-            self._defer_until_next_interval()
-            # Re-submit API request
-            return self.request(*args, request_hash=request_hash, **kwargs)
-        # Otherwise, return response
-        return response
+        Args:
+            calls       => positional and keyword arguments of each request
+            op_class    => operation class of token bucket (see: APIManager.__init__)
+        Returns:
+            Response for each call, in the same order as calls. Equivalent to calling
+            request for each call, but refills and consumes tokens once per batch rather
+            than once per request, and if the bucket runs out, sleeps once until enough
+            tokens are available for the rest of the batch. If any call fails (including
+            request hash generation and cached failures), the remaining requests are still
+            submitted before the first exception is raised.
+            NOTE: update_state is called once per batch, not once per request.
+        Preconditions:
+            N/A
+        Raises:
+            CachedFailureError: if a previous request with the same request hash failed
+            ValueError: if operation class has no token bucket
+            Exception: if request hash generation or API request fails
+        """
+        self._validate_op_class(op_class)
+        batch = self._prepare_batch(calls)
+        while batch:
+            defer_time, requests = self._take_requests(batch, op_class)
+            if defer_time:
+                time.sleep(defer_time)
+            outcomes: List[Any] = []
+            for request_hash, (_, args, kwargs) in requests:
+                try:
+                    outcomes.append(self._make_request(request_hash, op_class, *args, **kwargs))
+                except Exception as exc:    # pylint: disable=W0703
+                    outcomes.append(exc)
+                    continue
+                # If rate limit was reached, don't submit the rest of the batch
+                if outcomes[-1][1]:
+                    break
+            batch.record(requests, outcomes)
+        return batch.gen_results()
+
+    async def arequest_many(self,
+                            calls: Sequence[Tuple[tuple, dict]],
+                            op_class: str = DEFAULT_OP_CLASS) -> List[Any]:
+        """
+        Args:
+            calls       => positional and keyword arguments of each request
+            op_class    => operation class of token bucket (see: APIManager.__init__)
+        Returns:
+            Async version of request_many. Requests submitted for each batch of
+            available tokens are run concurrently with asyncio.gather.
+        Preconditions:
+            N/A
+        Raises:
+            CachedFailureError: if a previous request with the same request hash failed
+            ValueError: if operation class has no token bucket
+            Exception: if request hash generation or API request fails
+        """
+        self._validate_op_class(op_class)
+        batch = self._prepare_batch(calls)
+        while batch:
+            defer_time, requests = self._take_requests(batch, op_class)
+            if defer_time:
+                await asyncio.sleep(defer_time)
+            outcomes = await asyncio.gather(*(self._amake_request(request_hash, op_class, *args, **kwargs)
+                                              for request_hash, (_, args, kwargs) in requests),
+                                            return_exceptions=True)
+            batch.record(requests, list(outcomes))
+        return batch.gen_results()
 
 
 if os.environ.get("ENVIRONMENT") == "TEST":
-    import random
     import unittest
+    import unittest.mock
 
     from lc_cache import HashmapCache
 
@@ -279,7 +653,7 @@ if os.environ.get("ENVIRONMENT") == "TEST":
                 if rate_limit_reached:
                     raise RateLimitReachedError
                 return dict(
-                    interval_start=datetime.utcnow().timestamp(),
+                    interval_start=time.monotonic(),
                     requests_remaining=random.randrange(100, 500)
                 )
             if prefix_path == "/api/v1/person":
@@ -293,7 +667,25 @@ if os.environ.get("ENVIRONMENT") == "TEST":
                     name=endpoint,
                     country=random.choice(["USA", "Uganda", "Spain"]),
                 )
-            raise ValueError("Invalid API endpoint: {}".format(url))
+            raise ValueError(f"Invalid API endpoint: {url}")
+
+        async def arequest(self, url: str, rate_limit_reached: bool = False) -> Any:   # pylint: disable=W0221
+            await asyncio.sleep(0)
+            return self.request(url, rate_limit_reached)    # pylint: disable=E1121
+
+
+    class MockGetOrMissCache(HashmapCache):
+        """Mock cache that implements single lookup with a default value."""
+        __slots__ = ("lookups",)
+
+        def __init__(self) -> None:
+            super().__init__()
+            self.lookups = 0
+
+        def get_or_miss(self, key: Any, default: Any) -> Any:
+            """Retrieve value from cache, or default if not in cache."""
+            self.lookups += 1
+            return self._store.get(key, default)
 
 
     class MockAPIManager(APIManager):
@@ -303,8 +695,9 @@ if os.environ.get("ENVIRONMENT") == "TEST":
 
         def update_state(self):
             rate_limit = self._client.request("/api/v1/rate_limit")
-            self._start_time = rate_limit.get("interval_start")
-            self._count = rate_limit.get("requests_remaining")
+            for bucket in self._buckets.values():
+                bucket.set_state(min(bucket.threshold, rate_limit.get("requests_remaining")),
+                                 rate_limit.get("interval_start"))
 
 
     class TestAPIManager(unittest.TestCase):
@@ -316,11 +709,14 @@ if os.environ.get("ENVIRONMENT") == "TEST":
             self.api_limit_interval_buffer = 2
             self.api_limit_threshold = 500
 
-        def gen_api_manager(self) -> APIManager:
+        def gen_api_manager(self,
+                            threshold: Optional[Union[int, Dict[str, int]]] = None,
+                            client: Optional[APIClient] = None,
+                            cache: Optional[Cache] = None) -> APIManager:
             return APIManager(self.api_limit_interval,
-                              self.api_limit_threshold,
-                              MockAPIClient(),
-                              HashmapCache(),
+                              self.api_limit_threshold if threshold is None else threshold,
+                              client or MockAPIClient(),
+                              cache or HashmapCache(),
                               interval_buffer=self.api_limit_interval_buffer)
 
         def test_cache_api_response(self):
@@ -330,15 +726,227 @@ if os.environ.get("ENVIRONMENT") == "TEST":
             api_manager.request(request_url)
             self.assertTrue(api_manager.cache.check(parameters_hash))
 
+        def test_retry_after_rate_limit_reached(self):
+            client = MockAPIClient()
+            responses = [RateLimitReachedError(), RateLimitReachedError(), dict(name="peter")]
+            with unittest.mock.patch.object(client, "request", side_effect=responses) as request:
+                api_manager = self.gen_api_manager(client=client)
+                # Refill bucket instead of sleeping between retries
+                with unittest.mock.patch("time.sleep", side_effect=lambda _: api_manager.reset_state()) as sleep:
+                    self.assertEqual(dict(name="peter"), api_manager.request("/api/v1/person/peter"))
+            self.assertEqual(2, sleep.call_count)
+            self.assertEqual(3, request.call_count)
+
+        def test_make_request_rate_limit_reached(self):
+            api_manager = self.gen_api_manager()
+            response, rate_limit_reached = api_manager._make_request(None,
+                                                                     DEFAULT_OP_CLASS,
+                                                                     "/api/v1/rate_limit",
+                                                                     True)
+            self.assertIsNone(response)
+            self.assertTrue(rate_limit_reached)
+            self.assertEqual(0, api_manager.gen_remaining_requests())
+
+        def test_defer_backoff_bounds(self):
+            api_manager = self.gen_api_manager()
+            interval = self.api_limit_interval + self.api_limit_interval_buffer
+            api_manager._buckets[DEFAULT_OP_CLASS].drain()
+            defer_time = api_manager._gen_defer_time(api_manager._buckets[DEFAULT_OP_CLASS].gen_deficit_time(1), 20)
+            self.assertGreater(defer_time, 0.0)
+            # Jitter should be capped at the length of the interval
+            self.assertLessEqual(defer_time, interval / self.api_limit_threshold + interval)
+            # Pacing without the rate limit being reached should not add jitter
+            with unittest.mock.patch("random.uniform") as uniform:
+                self.assertEqual(1.5, api_manager._gen_defer_time(1.5))
+            uniform.assert_not_called()
+
+        def test_gen_request_hash_memoized(self):
+            api_manager = self.gen_api_manager()
+            request_url = "/api/v1/person/peter"
+            expected_hash = api_manager._client.gen_request_hash(request_url)
+            self.assertEqual(expected_hash, api_manager._gen_hash(request_url))
+            self.assertEqual(expected_hash, api_manager._gen_hash(request_url))
+            self.assertEqual(1, api_manager._gen_hash.cache_info().hits)
+            # Unhashable arguments fall back to uncached path
+            expected_hash = api_manager._client.gen_request_hash(request_url, params=dict(page=1))
+            self.assertEqual(expected_hash, api_manager._gen_hash(request_url, params=dict(page=1)))
+
+        def test_gen_request_hash_error(self):
+            api_manager = self.gen_api_manager()
+            self.assertRaises(TypeError, api_manager.request, type("Unhashable", (), dict(__hash__=None))())
+            # Exception raised by API client should propagate unchanged
+            client = MockAPIClient()
+            error = KeyError("page")
+            client.gen_request_hash = unittest.mock.Mock(side_effect=error)
+            api_manager = self.gen_api_manager(client=client)
+            with self.assertRaises(KeyError) as context:
+                api_manager.request("/api/v1/person/peter")
+            self.assertIs(error, context.exception)
+            self.assertEqual(1, client.gen_request_hash.call_count)
+
+        def test_cache_get_or_miss(self):
+            cache = MockGetOrMissCache()
+            api_manager = self.gen_api_manager(cache=cache)
+            request_url = "/api/v1/person/peter"
+            response = api_manager.request(request_url)
+            self.assertEqual(response, api_manager.request(request_url))
+            self.assertEqual(2, cache.lookups)
+            # None is a valid cached value
+            cache.insert(api_manager._client.gen_request_hash(request_url), None)
+            self.assertIsNone(api_manager.request(request_url))
+
+        def test_arequest_concurrent(self):
+            api_manager = self.gen_api_manager()
+            names = ["peter", "paul", "mary"]
+            async def gather_requests():
+                return await asyncio.gather(*(api_manager.arequest(f"/api/v1/person/{name}")
+                                              for name in names))
+            responses = asyncio.run(gather_requests())
+            self.assertEqual(names, [response.get("name") for response in responses])
+            self.assertEqual(self.api_limit_threshold - len(names), api_manager.gen_remaining_requests())
+            # Cached responses should be returned without consuming tokens
+            self.assertEqual(responses[0], asyncio.run(api_manager.arequest("/api/v1/person/peter")))
+            self.assertEqual(self.api_limit_threshold - len(names), api_manager.gen_remaining_requests())
+
+        def test_arequest_waiters_sleep_once(self):
+            # Mock API limits 20 requests/second, so that waiters sleep for at most a second
+            self.api_limit_interval, self.api_limit_interval_buffer, self.api_limit_threshold = 1, 0, 20
+            api_manager = self.gen_api_manager()
+            waiter_count = 20
+            sleep = asyncio.sleep
+            sleep_times = []
+            async def counting_sleep(delay):
+                if delay > 0:
+                    sleep_times.append(delay)
+                await sleep(delay)
+            async def gather_requests():
+                return await asyncio.gather(*(api_manager.arequest(f"/api/v1/person/person{index}")
+                                              for index in range(self.api_limit_threshold + waiter_count)))
+            with unittest.mock.patch("asyncio.sleep", side_effect=counting_sleep):
+                responses = asyncio.run(gather_requests())
+            self.assertEqual(self.api_limit_threshold + waiter_count, len(responses))
+            # Each waiter should reserve a token and sleep exactly once
+            self.assertEqual(waiter_count, len(sleep_times))
+
+        def test_op_class_buckets(self):
+            api_manager = self.gen_api_manager(threshold=dict(read=self.api_limit_threshold, write=2))
+            api_manager.request("/api/v1/person/peter", op_class="write")
+            api_manager.request("/api/v1/person/paul", op_class="write")
+            # Write bucket is exhausted, but read bucket is unaffected
+            self.assertEqual(0, api_manager.gen_remaining_requests("write"))
+            self.assertEqual(self.api_limit_threshold, api_manager.gen_remaining_requests("read"))
+            api_manager.request("/api/v1/person/mary", op_class="read")
+            self.assertEqual(self.api_limit_threshold - 1, api_manager.gen_remaining_requests("read"))
+            # Unknown operation class is rejected even if the response is cached
+            self.assertRaisesRegex(ValueError, "read, write", api_manager.request, "/api/v1/person/john")
+            self.assertRaisesRegex(ValueError, "read, write", api_manager.request, "/api/v1/person/mary")
+            # update_state should sync every bucket
+            api_manager = MockAPIManager(self.api_limit_interval,
+                                         dict(read=5, write=5),
+                                         MockAPIClient(),
+                                         HashmapCache())
+            self.assertEqual(dict(read=5, write=5), {op_class: api_manager.gen_remaining_requests(op_class)
+                                                     for op_class in ["read", "write"]})
+
+        def test_invalid_params(self):
+            client = MockAPIClient()
+            self.assertRaisesRegex(ValueError, "Interval must", APIManager, 0, 1, client, HashmapCache())
+            self.assertRaisesRegex(ValueError, "Threshold must", APIManager, 1, 0, client, HashmapCache())
+            self.assertRaisesRegex(ValueError, "Threshold must", APIManager, 1, dict(), client, HashmapCache())
+            self.assertRaisesRegex(ValueError,
+                                   "Interval buffer must",
+                                   APIManager, 1, 1, client, HashmapCache(), interval_buffer=-1)
+
+        def test_cache_on_failure(self):
+            api_manager = self.gen_api_manager()
+            request_url = "/api/v1/invalid/peter"
+            self.assertRaises(ValueError, api_manager.request, request_url)
+            self.assertEqual(self.api_limit_threshold - 1, api_manager.gen_remaining_requests())
+            # Failed request should not be re-submitted
+            self.assertRaisesRegex(CachedFailureError, "ValueError: Invalid", api_manager.request, request_url)
+            self.assertEqual(self.api_limit_threshold - 1, api_manager.gen_remaining_requests())
+            # Transient failures are not cached, so request can be retried
+            client = MockAPIClient()
+            with unittest.mock.patch.object(client, "request", side_effect=[ConnectionError, dict(name="peter")]):
+                api_manager = self.gen_api_manager(client=client)
+                self.assertRaises(ConnectionError, api_manager.request, "/api/v1/person/peter")
+                self.assertEqual(dict(name="peter"), api_manager.request("/api/v1/person/peter"))
+            # API client decides which failures are cached
+            client = MockAPIClient()
+            client.is_cacheable_failure = lambda exc: isinstance(exc, ConnectionError)
+            with unittest.mock.patch.object(client, "request", side_effect=[ConnectionError, ValueError, ValueError]):
+                api_manager = self.gen_api_manager(client=client)
+                self.assertRaises(ConnectionError, api_manager.request, "/api/v1/person/peter")
+                self.assertRaises(CachedFailureError, api_manager.request, "/api/v1/person/peter")
+                self.assertRaises(ValueError, api_manager.request, "/api/v1/person/paul")
+                self.assertRaises(ValueError, api_manager.request, "/api/v1/person/paul")
+
+        def test_request_many(self):
+            api_manager = self.gen_api_manager(threshold=2)
+            cached_response = api_manager.request("/api/v1/person/peter")
+            names = ["peter", "paul", "mary", "paul", "john"]
+            calls = [((f"/api/v1/person/{name}",), dict()) for name in names]
+            # Refill bucket instead of sleeping when bucket runs out
+            with unittest.mock.patch("time.sleep", side_effect=lambda _: api_manager.reset_state()) as sleep:
+                responses = api_manager.request_many(calls)
+            self.assertEqual(names, [response.get("name") for response in responses])
+            self.assertEqual(cached_response, responses[0])
+            self.assertIs(responses[1], responses[3])
+            # One token left after first request, so one deferral for the remaining two requests
+            self.assertEqual(1, sleep.call_count)
+            self.assertEqual(0, api_manager.gen_remaining_requests())
+            # A cached failure should not prevent the rest of the batch from being submitted
+            api_manager = self.gen_api_manager()
+            self.assertRaises(ValueError, api_manager.request, "/api/v1/invalid/paul")
+            calls = [(("/api/v1/person/paul",), dict()), (("/api/v1/invalid/paul",), dict()),
+                     (("/api/v1/person/mary",), dict())]
+            self.assertRaises(CachedFailureError, api_manager.request_many, calls)
+            for name in ["paul", "mary"]:
+                self.assertTrue(api_manager.cache.check(api_manager._client.gen_request_hash(f"/api/v1/person/{name}")))
+
+        def test_arequest_many(self):
+            api_manager = self.gen_api_manager()
+            names = ["peter", "paul", "mary"]
+            calls = [((f"/api/v1/person/{name}",), dict()) for name in names]
+            responses = asyncio.run(api_manager.arequest_many(calls))
+            self.assertEqual(names, [response.get("name") for response in responses])
+            self.assertEqual(self.api_limit_threshold - len(names), api_manager.gen_remaining_requests())
+            # Requests re-queued after the rate limit was reached are still submitted if another request fails
+            client = MockAPIClient()
+            api_manager = self.gen_api_manager(client=client)
+            calls = [(("/api/v1/person/paul",), dict()), (("/api/v1/invalid/paul",), dict())]
+            outcomes = [RateLimitReachedError(), ValueError("Invalid API endpoint"), dict(name="paul")]
+            with unittest.mock.patch.object(client, "request", side_effect=outcomes), \
+                 unittest.mock.patch("asyncio.sleep", side_effect=lambda delay: delay and api_manager.reset_state()):
+                self.assertRaises(ValueError, asyncio.run, api_manager.arequest_many(calls))
+            self.assertTrue(api_manager.cache.check(client.gen_request_hash("/api/v1/person/paul")))
+
+        def test_read_only_params(self):
+            api_manager = self.gen_api_manager()
+            self.assertEqual(self.api_limit_interval + self.api_limit_interval_buffer, api_manager.interval)
+            self.assertEqual(self.api_limit_interval_buffer, api_manager.interval_buffer)
+            self.assertEqual(self.api_limit_threshold, api_manager.threshold)
+            with self.assertRaises(AttributeError):
+                api_manager.threshold = 1
+            with self.assertRaises(AttributeError):
+                api_manager.cache = HashmapCache()
+            # Threshold map should not be changed through the caller's map or the returned map
+            thresholds = dict(read=5)
+            api_manager = self.gen_api_manager(threshold=thresholds)
+            thresholds["read"] = 1
+            api_manager.threshold["read"] = 1
+            self.assertEqual(dict(read=5), api_manager.threshold)
+            self.assertEqual(5, api_manager._buckets["read"].threshold)
+
         def test_no_requests_all_remaining(self):
             api_manager = self.gen_api_manager()
             self.assertEqual(self.api_limit_threshold, api_manager.gen_remaining_requests())
-            self.assertEqual(self.api_limit_interval + self.api_limit_interval_buffer,
-                             api_manager.gen_remaining_time())
+            self.assertEqual(0.0, api_manager.gen_remaining_time())
 
-        def test_errant_start_time(self):
+        def test_request_consumes_token(self):
             api_manager = self.gen_api_manager()
-            # Artificially set start time to be 20 seconds from now
-            api_manager.reset_state()
-            api_manager._start_time = datetime.utcnow().timestamp() + 20
-            self.assertRaises(ValueError, api_manager.gen_remaining_time)
+            api_manager.request("/api/v1/person/peter")
+            self.assertEqual(self.api_limit_threshold - 1, api_manager.gen_remaining_requests())
+            # Cached response should not consume a token
+            api_manager.request("/api/v1/person/peter")
+            self.assertEqual(self.api_limit_threshold - 1, api_manager.gen_remaining_requests())
@@ -0,0 +1,218 @@
+## -*- coding: UTF-8 -*-
+## request_batch.py
+##
+## Copyright (c) 2019 libcommon
+##
+## Permission is hereby granted, free of charge, to any person obtaining a copy
+## of this software and associated documentation files (the "Software"), to deal
+## in the Software without restriction, including without limitation the rights
+## to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+## copies of the Software, and to permit persons to whom the Software is
+## furnished to do so, subject to the following conditions:
+##
+## The above copyright notice and this permission notice shall be included in all
+## copies or substantial portions of the Software.
+##
+## THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+## IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+## FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+## AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+## LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+## OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+## SOFTWARE.
+
+
+
+
+import itertools
+import os
+from typing import Any, Dict, List, Optional, Tuple
+
+
+__author__ = "libcommon"
+
+
+# Request in a batch that isn't in the cache, as (request hash, (indices in calls, args, kwargs))
+PendingRequest = Tuple[Any, Tuple[List[int], tuple, dict]]
+
+
+class RequestBatch:
+    """Bookkeeping for a batch of API requests (see: APIManager.request_many).
+    Tracks the response for each call by index, requests that are yet to be
+    submitted, and the first exception raised by any call, so that every
+    request is submitted before the exception is raised.
+    """
+    __slots__ = (
+        "_error",
+        "_pending",
+        "_results",
+        "retry_attempt",
+    )
+
+    def __init__(self, count: int) -> None:
+        self._error: Optional[BaseException] = None
+        self._pending: Dict[Any, Tuple[List[int], tuple, dict]] = dict()
+        self._results: List[Any] = [None] * count
+        # Number of times the API signalled the rate limit was reached
+        self.retry_attempt = 0
+
+    def __contains__(self, request_hash: Any) -> bool:
+        return request_hash in self._pending
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    def add_request(self, index: int, request_hash: Any, args: tuple, kwargs: dict) -> None:
+        """
+        Args:
+            index           => index of call
+            request_hash    => hash of request parameters
+            args            => positional arguments of call
+            kwargs          => keyword arguments of call
+        Procedure:
+            Add call to the requests to submit. Calls with the same request hash
+            are submitted once.
+        Preconditions:
+            N/A
+        Raises:
+            N/A
+        """
+        if request_hash in self._pending:
+            self._pending[request_hash][0].append(index)
+        else:
+            self._pending[request_hash] = ([index], args, kwargs)
+
+    def add_response(self, index: int, response: Any) -> None:
+        """
+        Args:
+            index       => index of call
+            response    => response (or cached response) of call
+        Procedure:
+            Set response of call.
+        Preconditions:
+            N/A
+        Raises:
+            N/A
+        """
+        self._results[index] = response
+
+    def add_error(self, exc: BaseException) -> None:
+        """
+        Args:
+            exc     => exception raised by call
+        Procedure:
+            Record exception, to be raised once every request has been submitted
+            if it was the first exception raised (see: gen_results).
+        Preconditions:
+            N/A
+        Raises:
+            N/A
+        """
+        if self._error is None:
+            self._error = exc
+
+    def take(self, count: int) -> List[PendingRequest]:
+        """
+        Args:
+            count   => maximum number of requests to take
+        Returns:
+            Up to count requests to submit, in the order they were added.
+        Preconditions:
+            N/A
+        Raises:
+            N/A
+        """
+        requests = list(itertools.islice(self._pending.items(), count))
+        for request_hash, _ in requests:
+            del self._pending[request_hash]
+        return requests
+
+    def record(self, requests: List[PendingRequest], outcomes: List[Any]) -> None:
+        """
+        Args:
+            requests    => requests submitted (see: take)
+            outcomes    => outcome of each request, as (response, rate limit reached)
+                           or the exception it raised
+        Procedure:
+            Record outcome of each request. Requests that hit the rate limit, or have
+            no outcome because they weren't submitted, are re-queued, and if any request
+            hit the rate limit retry_attempt is incremented.
+        Preconditions:
+            N/A
+        Raises:
+            N/A
+        """
+        outcomes = outcomes + [(None, True)] * (len(requests) - len(outcomes))
+        rate_limit_reached = False
+        for (request_hash, request), outcome in zip(requests, outcomes):
+            if isinstance(outcome, BaseException):
+                self.add_error(outcome)
+            elif outcome[1]:
+                rate_limit_reached = True
+                self._pending[request_hash] = request
+            else:
+                for index in request[0]:
+                    self._results[index] = outcome[0]
+        self.retry_attempt += rate_limit_reached
+
+    def gen_results(self) -> List[Any]:
+        """
+        Args:
+            N/A
+        Returns:
+            Response for each call, in the same order as calls.
+        Preconditions:
+            Every request has been submitted
+        Raises:
+            Exception: first exception raised by any call
+        """
+        if self._error is not None:
+            raise self._error
+        return self._results
+
+
+if os.environ.get("ENVIRONMENT") == "TEST":
+    import unittest
+
+
+    class TestRequestBatch(unittest.TestCase):
+        """Test RequestBatch methods."""
+
+        def setUp(self) -> None:
+            self.calls: List[Tuple[tuple, dict]] = [((f"/api/v1/person/{name}",), dict())
+                                                    for name in ["peter", "paul", "mary", "paul"]]
+
+        def gen_batch(self) -> RequestBatch:
+            batch = RequestBatch(len(self.calls))
+            for index, (args, kwargs) in enumerate(self.calls):
+                batch.add_request(index, args[0], args, kwargs)
+            return batch
+
+        def test_duplicate_requests_submitted_once(self):
+            batch = self.gen_batch()
+            self.assertEqual(3, len(batch))
+            requests = batch.take(3)
+            self.assertEqual([0], requests[0][1][0])
+            self.assertEqual([1, 3], requests[1][1][0])
+            batch.record(requests, [("peter", False), ("paul", False), ("mary", False)])
+            self.assertEqual(0, len(batch))
+            self.assertEqual(["peter", "paul", "mary", "paul"], batch.gen_results())
+
+        def test_requeue_rate_limited(self):
+            batch = self.gen_batch()
+            requests = batch.take(3)
+            # Requests without an outcome were not submitted, so are re-queued as if rate limited
+            batch.record(requests, [("peter", False), (None, True)])
+            self.assertEqual(1, batch.retry_attempt)
+            self.assertEqual(2, len(batch))
+            self.assertIn("/api/v1/person/paul", batch)
+            self.assertIn("/api/v1/person/mary", batch)
+            self.assertNotIn("/api/v1/person/peter", batch)
+
+        def test_first_error_raised_after_results(self):
+            batch = self.gen_batch()
+            batch.add_error(KeyError("first"))
+            requests = batch.take(3)
+            batch.record(requests, [ValueError("second"), ("paul", False), ("mary", False)])
+            self.assertEqual(0, len(batch))
+            self.assertRaisesRegex(KeyError, "first", batch.gen_results)
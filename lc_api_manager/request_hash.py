@@ -0,0 +1,155 @@
+## -*- coding: UTF-8 -*-
+## request_hash.py
+##
+## Copyright (c) 2019 libcommon
+##
+## Permission is hereby granted, free of charge, to any person obtaining a copy
+## of this software and associated documentation files (the "Software"), to deal
+## in the Software without restriction, including without limitation the rights
+## to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+## copies of the Software, and to permit persons to whom the Software is
+## furnished to do so, subject to the following conditions:
+##
+## The above copyright notice and this permission notice shall be included in all
+## copies or substantial portions of the Software.
+##
+## THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+## IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+## FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+## AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+## LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+## OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+## SOFTWARE.
+
+
+
+
+import functools
+import os
+from typing import Any, Callable
+
+
+__author__ = "libcommon"
+
+
+# Types of arguments for which request hashes are memoized (see: gen_memo_key)
+_MEMO_TYPES = (str, bytes, int, float, bool, type(None))
+
+
+def gen_memo_key(value: Any) -> Any:
+    """
+    Args:
+        value   => argument(s) to API client's gen_request_hash method
+    Returns:
+        Value tagged with its type (recursively for tuples), or None if value (or any
+        item in it) isn't an immutable primitive (see: _MEMO_TYPES). Tagging every item
+        with its type ensures i.e. (1,) and (True,) have distinct memo keys, whereas
+        lru_cache(typed=True) only distinguishes the types of top-level arguments.
+    Preconditions:
+        N/A
+    Raises:
+        N/A
+    """
+    value_type = type(value)
+    if value_type is tuple:
+        items = tuple(gen_memo_key(item) for item in value)
+        return None if None in items else (tuple, items)
+    if value_type in _MEMO_TYPES:
+        return value_type, value
+    return None
+
+
+class RequestHasher:
+    """Generate request hashes with an API client's gen_request_hash method.
+    Hashes are memoized for repeated identical arguments if every argument is
+    an immutable primitive. Otherwise (i.e., a dict, list, or object that may be
+    mutated), the API client is called every time, so that a stale or colliding
+    hash is never returned.
+    """
+    __slots__ = ("_gen_hash", "_gen_hash_memoized")
+
+    def __init__(self, gen_hash: Callable[..., Any], maxsize: int = 1024) -> None:
+        self._gen_hash = gen_hash
+        self._gen_hash_memoized = functools.lru_cache(maxsize=maxsize)(self._gen_tagged_hash)
+
+    def __call__(self, *args, **kwargs) -> Any:
+        """
+        Args:
+            Takes any positional or keyword arguments
+        Returns:
+            Hash of request parameters from the API client, memoized if possible.
+        Preconditions:
+            N/A
+        Raises:
+            Exception: if API client fails to generate request hash
+        """
+        kwargs_items = tuple(kwargs.items())
+        memo_key = gen_memo_key((args, kwargs_items))
+        if memo_key is None:
+            return self._gen_hash(*args, **kwargs)
+        return self._gen_hash_memoized(memo_key, args, kwargs_items)
+
+    def cache_info(self) -> Any:
+        """Memoization statistics (see: functools.lru_cache)."""
+        return self._gen_hash_memoized.cache_info()
+
+    def _gen_tagged_hash(self, memo_key: Any, args: tuple, kwargs_items: tuple) -> Any:   # pylint: disable=W0613
+        """
+        Args:
+            memo_key        => memo key of args and kwargs (see: gen_memo_key)
+            args            => positional arguments
+            kwargs_items    => keyword arguments, as (key, value) pairs
+        Returns:
+            Hash of request parameters from the API client. Memo key is part of the
+            memoized arguments, so that arguments which are equal but have different
+            types (i.e., 1 and True) are memoized separately.
+        Preconditions:
+            N/A
+        Raises:
+            Exception: if API client fails to generate request hash
+        """
+        return self._gen_hash(*args, **dict(kwargs_items))
+
+
+if os.environ.get("ENVIRONMENT") == "TEST":
+    import json
+    import types
+    import unittest
+
+
+    class TestRequestHasher(unittest.TestCase):
+        """Test RequestHasher methods."""
+
+        def setUp(self) -> None:
+            self.calls = 0
+
+        def gen_hash(self, *args, **kwargs) -> str:
+            self.calls += 1
+            return json.dumps([args, kwargs])
+
+        def test_memoized(self):
+            hasher = RequestHasher(self.gen_hash)
+            expected_hash = self.gen_hash("/api/v1/person/peter", page=1)
+            self.assertEqual(expected_hash, hasher("/api/v1/person/peter", page=1))
+            self.assertEqual(expected_hash, hasher("/api/v1/person/peter", page=1))
+            self.assertEqual(2, self.calls)
+            self.assertEqual(1, hasher.cache_info().hits)
+
+        def test_nested_types_distinct(self):
+            hasher = RequestHasher(self.gen_hash)
+            self.assertNotEqual(hasher(("x", (1,))), hasher(("x", (True,))))
+            self.assertNotEqual(hasher(("x", (1,))), hasher(("x", (1.0,))))
+            self.assertEqual(3, hasher.cache_info().currsize)
+
+        def test_not_memoized(self):
+            hasher = RequestHasher(lambda params: params.page)
+            # Objects that may be mutated should not be memoized
+            params = types.SimpleNamespace(page=1)
+            self.assertEqual(1, hasher(params))
+            params.page = 2
+            self.assertEqual(2, hasher(params))
+            # Unhashable arguments should not be memoized
+            hasher = RequestHasher(self.gen_hash)
+            self.assertEqual(self.gen_hash("/api/v1/person/peter", params=dict(page=1)),
+                             hasher("/api/v1/person/peter", params=dict(page=1)))
+            self.assertEqual(0, hasher.cache_info().currsize)
@@ -0,0 +1,302 @@
+## -*- coding: UTF-8 -*-
+## token_bucket.py
+##
+## Copyright (c) 2019 libcommon
+##
+## Permission is hereby granted, free of charge, to any person obtaining a copy
+## of this software and associated documentation files (the "Software"), to deal
+## in the Software without restriction, including without limitation the rights
+## to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+## copies of the Software, and to permit persons to whom the Software is
+## furnished to do so, subject to the following conditions:
+##
+## The above copyright notice and this permission notice shall be included in all
+## copies or substantial portions of the Software.
+##
+## THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+## IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+## FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+## AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+## LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+## OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+## SOFTWARE.
+
+
+
+
+import os
+import threading
+import time
+from typing import Optional
+
+
+__author__ = "libcommon"
+
+
+class TokenBucket:
+    """Token bucket rate limiter. Tokens accrue continuously at a rate of
+    threshold / interval tokens per second, up to a capacity of threshold
+    tokens, and each request consumes one token. Requests that can't wait for
+    a token without a busy loop reserve one instead (see: reserve), in which
+    case the number of tokens goes negative. Safe to share between threads.
+    """
+    __slots__ = (
+        "_interval",
+        "_last_refill",
+        "_lock",
+        "_threshold",
+        "_tokens",
+    )
+
+    def __init__(self, threshold: int, interval: int) -> None:
+        self._threshold = threshold
+        self._interval = interval
+        # NOTE: Bucket starts full, and last refill time is always a real timestamp
+        # rather than a sentinel, so refilling requires no special case for an unset
+        # start time, and APIManager child classes that only set the number of tokens
+        # in update_state are not overridden by the first refill.
+        self._tokens = float(threshold)
+        self._last_refill = time.monotonic()
+        # NOTE: Guards refilling and consuming tokens, so that threads sharing
+        # a bucket don't lose updates
+        self._lock = threading.Lock()
+
+    @property
+    def threshold(self) -> int:
+        """Capacity of the bucket (number of requests allowed per interval)."""
+        return self._threshold
+
+    @property
+    def interval(self) -> int:
+        """Length of rate limit interval in seconds."""
+        return self._interval
+
+    def set_state(self, tokens: float, last_refill: Optional[float] = None) -> None:
+        """
+        Args:
+            tokens          => number of tokens in the bucket
+            last_refill     => last refill time (default: current value of time.monotonic)
+        Procedure:
+            Set number of tokens and last refill time, i.e. from a rate limit endpoint
+            in APIManager.update_state. Outstanding reservations are discarded.
+        Preconditions:
+            last_refill is measured with the monotonic clock (see: time.monotonic)
+        Raises:
+            N/A
+        """
+        if last_refill is None:
+            last_refill = time.monotonic()
+        with self._lock:
+            self._tokens = float(tokens)
+            self._last_refill = last_refill
+
+    def reset(self) -> None:
+        """
+        Args:
+            N/A
+        Procedure:
+            Refill bucket to capacity and reset last refill time.
+        Preconditions:
+            N/A
+        Raises:
+            N/A
+        """
+        self.set_state(self._threshold)
+
+    def drain(self) -> None:
+        """
+        Args:
+            N/A
+        Procedure:
+            Empty the bucket, i.e. when the API signals that the rate limit was reached.
+            Outstanding reservations are kept, so waiters are still served in order.
+        Preconditions:
+            N/A
+        Raises:
+            N/A
+        """
+        with self._lock:
+            self._tokens = min(self._refill(), 0.0)
+
+    def _refill(self) -> float:
+        """
+        Args:
+            N/A
+        Returns:
+            Number of tokens in the bucket after adding tokens accrued since the last refill
+            at a rate of threshold / interval tokens per second, up to a maximum of threshold.
+        Preconditions:
+            Caller holds _lock
+        Raises:
+            N/A
+        """
+        tokens, last_refill = self._tokens, self._last_refill
+        current_ts = time.monotonic()
+        accrued = (current_ts - last_refill) * self._threshold / self._interval
+        self._tokens = min(float(self._threshold), tokens + accrued)
+        self._last_refill = current_ts
+        return self._tokens
+
+    def consume(self, count: int) -> int:
+        """
+        Args:
+            count   => maximum number of tokens to consume
+        Returns:
+            Refill bucket once, consume up to count whole tokens, and return the number
+            of tokens consumed.
+        Preconditions:
+            N/A
+        Raises:
+            N/A
+        """
+        # NOTE: Interval rollover is implicit in the refill, so no separate
+        # check against the interval is required.
+        with self._lock:
+            consumed = max(0, min(int(self._refill()), count))
+            self._tokens -= consumed
+        return consumed
+
+    def reserve(self) -> float:
+        """
+        Args:
+            N/A
+        Returns:
+            Refill bucket once, consume one token whether or not it is available yet,
+            and return the amount of time in seconds until the reserved token is
+            available (0 if it is available now).
+        Preconditions:
+            Caller waits for the returned amount of time before making the request
+        Raises:
+            N/A
+        """
+        # NOTE: Each waiter reserves its token before sleeping, so concurrent waiters
+        # sleep exactly once, and are served in the order they reserved, rather than
+        # all waking for the same token and going back to sleep.
+        with self._lock:
+            self._tokens = self._refill() - 1
+            return max(0.0, -self._tokens) * self._interval / self._threshold
+
+    def gen_deficit_time(self, count: int) -> float:
+        """
+        Args:
+            count   => number of tokens required
+        Returns:
+            Amount of time in seconds until count tokens (capped at bucket capacity) are available,
+            or 0 if they are available now. Computed from the number of tokens as of the last
+            refill, without reading the clock, so use when the bucket was just refilled.
+        Preconditions:
+            N/A
+        Raises:
+            N/A
+        """
+        count = min(count, self._threshold)
+        tokens = self._tokens
+        if tokens >= count:
+            return 0.0
+        return (count - tokens) * self._interval / self._threshold
+
+    def gen_remaining_time(self) -> float:
+        """
+        Args:
+            N/A
+        Returns:
+            Amount of time in seconds until the next token is available in the bucket,
+            or 0 if a token is available now.
+        Preconditions:
+            N/A
+        Raises:
+            N/A
+        """
+        with self._lock:
+            self._refill()
+            return self.gen_deficit_time(1)
+
+    def gen_remaining_requests(self) -> int:
+        """
+        Args:
+            N/A
+        Returns:
+            Number of requests that can be made without waiting (number of whole tokens
+            in the bucket after refilling, or 0 if tokens are reserved).
+        Preconditions:
+            N/A
+        Raises:
+            N/A
+        """
+        with self._lock:
+            return max(0, int(self._refill()))
+
+
+if os.environ.get("ENVIRONMENT") == "TEST":
+    import unittest
+    import unittest.mock
+
+
+    class TestTokenBucket(unittest.TestCase):
+        """Test TokenBucket methods."""
+
+        def setUp(self) -> None:
+            # 500 requests/hour
+            self.interval = 3600
+            self.threshold = 500
+
+        def test_new_bucket_full(self):
+            bucket = TokenBucket(self.threshold, self.interval)
+            self.assertEqual(self.threshold, bucket.gen_remaining_requests())
+            self.assertEqual(0.0, bucket.gen_remaining_time())
+
+        def test_consume_up_to_available(self):
+            bucket = TokenBucket(self.threshold, self.interval)
+            self.assertEqual(1, bucket.consume(1))
+            self.assertEqual(self.threshold - 1, bucket.gen_remaining_requests())
+            # Only whole tokens that are available are consumed
+            self.assertEqual(self.threshold - 1, bucket.consume(self.threshold))
+            self.assertEqual(0, bucket.consume(1))
+
+        def test_empty_bucket_remaining_time(self):
+            bucket = TokenBucket(self.threshold, self.interval)
+            bucket.drain()
+            # Time until next token should be at most the time to accrue one token
+            self.assertLessEqual(bucket.gen_remaining_time(), self.interval / self.threshold)
+            self.assertGreater(bucket.gen_remaining_time(), 0.0)
+            bucket.reset()
+            self.assertEqual(self.threshold, bucket.gen_remaining_requests())
+
+        def test_reserve_in_order(self):
+            bucket = TokenBucket(self.threshold, self.interval)
+            with unittest.mock.patch("time.monotonic", return_value=time.monotonic()):
+                bucket.drain()
+                # Each reservation waits one token longer than the previous one
+                wait_times = [bucket.reserve() for _ in range(3)]
+                self.assertEqual([index * self.interval / self.threshold for index in range(1, 4)], wait_times)
+                self.assertEqual(0, bucket.consume(1))
+                self.assertEqual(0, bucket.gen_remaining_requests())
+                # Draining the bucket should keep outstanding reservations
+                bucket.drain()
+                self.assertEqual(4 * self.interval / self.threshold, bucket.reserve())
+
+        def test_refill_capped_at_threshold(self):
+            bucket = TokenBucket(self.threshold, self.interval)
+            bucket.set_state(0.0, time.monotonic() - 2 * self.interval)
+            self.assertEqual(self.threshold, bucket.gen_remaining_requests())
+
+        def test_concurrent_threads_consume_tokens(self):
+            bucket = TokenBucket(self.threshold, self.interval)
+            thread_count, requests_per_thread = 4, 50
+            monotonic = time.monotonic
+            def yielding_monotonic():
+                # Switch threads between reading and updating the bucket, so that
+                # unsynchronized updates would be lost
+                time.sleep(0)
+                return monotonic()
+            def consume():
+                for _ in range(requests_per_thread):
+                    bucket.consume(1)
+            threads = [threading.Thread(target=consume) for _ in range(thread_count)]
+            with unittest.mock.patch("time.monotonic", side_effect=yielding_monotonic):
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+            self.assertEqual(self.threshold - thread_count * requests_per_thread,
+                             bucket.gen_remaining_requests())